@@ -1,5 +1,13 @@
+import asyncio
+import concurrent.futures
+import ctypes
+import errno
 import logging
 import os
+import queue
+import signal
+import socket
+import sqlite3
 import sys
 import threading
 from typing import Any, Optional
@@ -9,140 +17,630 @@ import pyodbc
 from dotenv import load_dotenv
 
 
-def setup_syslog_logging(server:str ='172.16.13.5', port:int=514):
-    """設定 Syslog 處理器"""
+class _IOVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+
+class _MsgHdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p), ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(_IOVec)), ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p), ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class _MMsgHdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', _MsgHdr), ('msg_len', ctypes.c_uint)]
+
+
+def _load_sendmmsg():
+    """在 Linux 上透過 ctypes 取得 libc 的 sendmmsg()，其他平台回傳 None。"""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        func = ctypes.CDLL(None, use_errno=True).sendmmsg
+    except (OSError, AttributeError):
+        return None
+    func.argtypes = [ctypes.c_int, ctypes.POINTER(_MMsgHdr), ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+
+_sendmmsg = _load_sendmmsg()
+
+
+def _send_datagrams(sock: socket.socket, datagrams: list[bytes]):
+    """將多個 UDP 封包送到已 connect 的 socket，可用時以單次 sendmmsg() 送出。"""
+    if _sendmmsg is None:
+        for datagram in datagrams:
+            sock.send(datagram)
+        return
+
+    count = len(datagrams)
+    iovecs = (_IOVec * count)()
+    msgs = (_MMsgHdr * count)()
+    for i, datagram in enumerate(datagrams):
+        # c_char_p points at the bytes object's own buffer; `datagrams` keeps it alive.
+        iovecs[i].iov_base = ctypes.cast(ctypes.c_char_p(datagram), ctypes.c_void_p).value
+        iovecs[i].iov_len = len(datagram)
+        msgs[i].msg_hdr.msg_iov = ctypes.pointer(iovecs[i])
+        msgs[i].msg_hdr.msg_iovlen = 1
+
+    sent = 0
+    while sent < count:
+        result = _sendmmsg(sock.fileno(), ctypes.byref(msgs[sent]), count - sent, 0)
+        if result < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+            raise OSError(err, os.strerror(err))
+        sent += result
+
+
+class DeliveryStats:
+    """一個呼叫端 (例如一個監控器) 交給 writer 執行緒之批次的送出狀態。"""
+
+    def __init__(self):
+        # Batches handed to the writer and not yet sent (or dropped).
+        self.in_flight = 0
+        # dropped is reset by take_dropped(); dropped_total only grows, so the owner can tell
+        # whether anything was dropped between two points in time.
+        self.dropped = 0
+        self.dropped_total = 0
+
+
+class BufferedSysLogHandler(SysLogHandler):
+    """將 syslog 訊息暫存於緩衝區，累積到上限或呼叫 flush() 時才交由 writer 執行緒一次送出。"""
+
+    # TCP 緩衝區累積到此大小 (bytes) 時自動送出
+    MAX_BUFFER_BYTES = 64 * 1024
+    # UDP 累積到此封包數時自動送出 (一次 sendmmsg)
+    MAX_DATAGRAMS = 100
+    # 合併多筆訊息時單一 UDP 封包的上限 (bytes)，保持在一般 MTU 以內避免 IP 分段
+    MAX_DATAGRAM_BYTES = 1400
+    # 等待 writer 執行緒送出的批次上限
+    MAX_QUEUED_BATCHES = 64
+    # 佇列已滿時最多等待的秒數，逾時後才捨棄這批訊息並計入 dropped
+    ENQUEUE_TIMEOUT = 5
+    # wait_sent() 預設等待 writer 送完所有批次的秒數
+    SEND_TIMEOUT = 30
+
+    def __init__(self, address=('localhost', 514), facility=SysLogHandler.LOG_USER, socktype=None, coalesce_udp:bool=False):
+        # TCP: octet-counted stream data. UDP with coalesce_udp: the datagram being assembled.
+        self.buffer = bytearray()
+        self.datagrams: list[bytes] = []
+        # Number of messages in the current buffer.
+        self.pending = 0
+        # Only enable when the receiver accepts several newline-separated messages per datagram.
+        self.coalesce_udp = coalesce_udp
+        # Every batch belongs to a single DeliveryStats, so each caller only sees its own drops and
+        # in-flight batches. Records from emit() are accounted to log_delivery.
+        self.log_delivery = DeliveryStats()
+        self._owner = self.log_delivery
+        # Guards the counters of every DeliveryStats.
+        self._writer_state = threading.Condition()
+        super().__init__(address, facility, socktype)
+
+        # All socket I/O happens on a dedicated writer thread. A slow syslog server fills the bounded
+        # queue, which then blocks producers for up to ENQUEUE_TIMEOUT before a batch is dropped.
+        self.queue: queue.Queue = queue.Queue(maxsize=self.MAX_QUEUED_BATCHES)
+        self.writer = threading.Thread(target=self._writer_loop, name='syslog-writer', daemon=True)
+        self.writer.start()
+
+    def createSocket(self):
+        super().createSocket()
+        # Connect UDP sockets too, so batches can be sent without a per-datagram address.
+        if self.socket is not None and not self.unixsocket and self.socktype == socket.SOCK_DGRAM:
+            self.socket.connect(self.address)
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            if self.ident:
+                msg = self.ident + msg
+            if self.append_nul and self.socktype == socket.SOCK_DGRAM and not self.coalesce_udp:
+                msg += '\000'
+            prio = '<%d>' % self.encodePriority(self.facility, self.mapPriority(record.levelname))
+            self._append((prio + msg).encode('utf-8'), self.log_delivery)
+        except Exception:
+            self.handleError(record)
+
+    def _append(self, frame: bytes, owner: DeliveryStats):
+        """將一個已編碼的 syslog 訊息加入緩衝區 (呼叫端須持有 handler lock)。"""
+        if owner is not self._owner:
+            # Hand over the other caller's messages first, so the batch has a single owner.
+            self._enqueue_buffer()
+            self._owner = owner
+        self.pending += 1
+        if self.socktype == socket.SOCK_DGRAM:
+            if not self.coalesce_udp:
+                self.datagrams.append(frame)
+            else:
+                # The receiver splits on newlines, so a multi-line message (e.g. a traceback from
+                # logger.exception) would arrive as header-less fragments. Escape LF the way rsyslog does.
+                if b'\n' in frame:
+                    frame = frame.replace(b'\n', b'#012')
+                # Pack newline-separated messages into one datagram while it fits in MAX_DATAGRAM_BYTES.
+                if self.buffer and len(self.buffer) + 1 + len(frame) > self.MAX_DATAGRAM_BYTES:
+                    self.datagrams.append(bytes(self.buffer))
+                    self.buffer.clear()
+                if self.buffer:
+                    self.buffer += b'\n'
+                self.buffer += frame
+            if len(self.datagrams) >= self.MAX_DATAGRAMS:
+                self._enqueue_buffer()
+        else:
+            # RFC 6587 octet-counting framing: "<length> <message>"
+            self.buffer += b'%d ' % len(frame)
+            self.buffer += frame
+            if len(self.buffer) >= self.MAX_BUFFER_BYTES:
+                self._enqueue_buffer()
+
+    def write_messages(self, messages: list[str], delivery: DeliveryStats):
+        """將已格式化的 syslog 訊息 (例如 DISPLAY_JOURNAL 產生的 RFC5424 字串) 直接寫入緩衝區，送出狀態記在 delivery。"""
+        self.acquire()
+        try:
+            for message in messages:
+                self._append(message.encode('utf-8'), delivery)
+        finally:
+            self.release()
+
+    def _enqueue_buffer(self):
+        """將目前緩衝區交給 writer 執行緒；佇列持續滿載超過 ENQUEUE_TIMEOUT 時捨棄這批訊息並計入 dropped。"""
+        if not self.pending:
+            return
+        if self.socktype == socket.SOCK_DGRAM:
+            if self.buffer:
+                self.datagrams.append(bytes(self.buffer))
+            batch = self.datagrams
+        else:
+            batch = bytes(self.buffer)
+        # Blocking here (with the handler lock held) slows the poller down to the writer's pace.
+        owner = self._owner
+        try:
+            self.queue.put((batch, self.pending, owner), timeout=self.ENQUEUE_TIMEOUT)
+        except queue.Full:
+            self._count_dropped(owner, self.pending)
+            if owner is self.log_delivery:
+                # No monitor reports these, and logging them here would re-enter this handler.
+                print(f"Dropped {self.pending} operational syslog messages: the send queue stayed full.", file=sys.stderr)
+        else:
+            with self._writer_state:
+                owner.in_flight += 1
+        self.datagrams = []
+        self.buffer.clear()
+        self.pending = 0
+
+    def _writer_loop(self):
+        """writer 執行緒：依序送出佇列中的批次，直到收到 None。"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch, count, owner = item
+            try:
+                if self.socket is None:
+                    self.createSocket()
+                if self.socktype == socket.SOCK_DGRAM:
+                    _send_datagrams(self.socket, batch)
+                else:
+                    self.socket.sendall(batch)
+            except OSError as e:
+                print(f"Failed to send buffered syslog messages: {e}", file=sys.stderr)
+                self._count_dropped(owner, count)
+                if self.socket is not None and self.socktype == socket.SOCK_STREAM:
+                    # Drop the broken TCP connection; it is re-created on the next send.
+                    self.socket.close()
+                    self.socket = None
+            with self._writer_state:
+                owner.in_flight -= 1
+                self._writer_state.notify_all()
+
+    def _count_dropped(self, owner: DeliveryStats, count: int):
+        with self._writer_state:
+            owner.dropped += count
+            owner.dropped_total += count
+
+    def take_dropped(self, delivery: DeliveryStats) -> int:
+        """回傳 delivery 自上次呼叫以來被捨棄的訊息數，並將計數歸零。"""
+        with self._writer_state:
+            dropped, delivery.dropped = delivery.dropped, 0
+        return dropped
+
+    def wait_sent(self, delivery: DeliveryStats, timeout:float = SEND_TIMEOUT) -> bool:
+        """等待 writer 處理完 delivery 所有已交付的批次；逾時仍未完成時回傳 False。"""
+        with self._writer_state:
+            return self._writer_state.wait_for(lambda: delivery.in_flight == 0, timeout)
+
+    def flush(self):
+        """將緩衝區中所有訊息交給 writer 執行緒送出。"""
+        self.acquire()
+        try:
+            self._enqueue_buffer()
+        finally:
+            self.release()
+
+    def close(self):
+        self.flush()
+        # Let the writer send what is already queued, but do not hang on a stuck server at exit.
+        try:
+            self.queue.put(None, timeout=5)
+        except queue.Full:
+            pass
+        self.writer.join(timeout=5)
+        super().close()
+
+
+class BookmarkStore:
+    """以 SQLite 保存各主機、各日誌的書籤，讓程式重新啟動後能從上次的位置繼續。"""
+
+    def __init__(self, path:str):
+        # One connection shared by all monitor threads; access is serialised with a lock.
+        self.conn = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        # WAL + synchronous=NORMAL: every save is still an atomic commit, so a crash never leaves a
+        # half-written bookmark, but the fsync happens at checkpoints and on close, not on every cycle.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        # A bookmark belongs to one journal on one host: the same host can be monitored for several
+        # journals, and a receiver from one journal is meaningless for another.
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS journal_bookmarks("
+            "host TEXT, journal_lib TEXT, journal_name TEXT, "
+            "receiver_library TEXT, receiver TEXT, seq INTEGER, "
+            "PRIMARY KEY (host, journal_lib, journal_name))"
+        )
+
+    def load(self, host:str, journal_lib:str, journal_name:str) -> Optional[tuple[str, str, int]]:
+        """讀取日誌的書籤 (receiver_library, receiver, seq)，尚未保存過則回傳 None。"""
+        with self.lock:
+            return self.conn.execute(
+                "SELECT receiver_library, receiver, seq FROM journal_bookmarks "
+                "WHERE host = ? AND journal_lib = ? AND journal_name = ?",
+                (host, journal_lib, journal_name),
+            ).fetchone()
+
+    def save(self, host:str, journal_lib:str, journal_name:str, receiver_library:str, receiver:str, seq:int):
+        """以單一 INSERT OR REPLACE 更新日誌的書籤。"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO journal_bookmarks"
+                "(host, journal_lib, journal_name, receiver_library, receiver, seq) VALUES (?, ?, ?, ?, ?, ?)",
+                (host, journal_lib, journal_name, receiver_library, receiver, seq),
+            )
+
+    def close(self):
+        """將 WAL 內容寫回資料庫檔案並關閉連線。"""
+        with self.lock:
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.close()
+
+
+def setup_syslog_logging(server:str ='172.16.13.5', port:int=514, protocol:str='udp', coalesce_udp:bool=False, level:str='INFO'):
+    """設定 Syslog 處理器與主控台輸出；level 為主控台 (與 root logger) 的記錄等級"""
     logger = logging.getLogger()
-    logger.setLevel(logging.DEBUG)
-    handler = SysLogHandler(address=(server, port))
+    # The root level also gates logger.isEnabledFor(), so debug diagnostics (including asyncio's)
+    # are not even formatted unless level is DEBUG.
+    logger.setLevel(level)
+    socktype = socket.SOCK_STREAM if protocol.lower() == 'tcp' else socket.SOCK_DGRAM
+    handler = BufferedSysLogHandler(address=(server, port), socktype=socktype, coalesce_udp=coalesce_udp)
+    # Debug diagnostics stay on the console; only INFO and above are forwarded to syslog.
+    handler.setLevel(logging.INFO)
     logger.addHandler(handler)
-    return logger
+    console = logging.StreamHandler(sys.stdout)
+    console.setLevel(level)
+    console.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
+    logger.addHandler(console)
+    return logger, handler
 
 
 class IbmiJournalMonitor:
     """管理 IBM i 稽核日誌的連線、查詢和日誌發送。"""
 
-    # 將 severity_map 移至類別層級，因為它對所有實例都是一樣的
-    SEVERITY_MAP = {
-        0: logging.CRITICAL, # Emergency
-        1: logging.CRITICAL, # Alert
-        2: logging.CRITICAL, # Critical
-        3: logging.ERROR,    # Error
-        4: logging.WARNING,  # Warning
-        5: logging.INFO,     # Notice
-        6: logging.INFO,     # Informational
-        7: logging.DEBUG,    # Debug
-    }
-
-    def __init__(self, host:str, user:str, password:str, driver:str, logger:logging.Logger, journal_lib:str, journal_name:str, journal_types:str, interval:int):
-        # Final Solution: Reverting to the simplest connection string from the successful testing.py.
-        # This avoids the SQL0443 error that occurs when NAMING=1 is combined with STARTING_* parameters in the UDF call.
+    # 每次 fetchmany() 取回的列數預設值
+    FETCH_SIZE = 1000
+    # 建立連線的逾時秒數，避免主機無回應時該監控器卡住
+    LOGIN_TIMEOUT = 30
+
+    def __init__(self, host:str, user:str, password:str, driver:str, logger:logging.Logger, syslog_handler:BufferedSysLogHandler, bookmarks:BookmarkStore, journal_lib:str, journal_name:str, journal_types:str, interval:int, max_interval:Optional[int] = None, fetch_size:int = FETCH_SIZE, client_type_filter:bool = False, query_timeout:int = 0):
+        # NAMING=0 (SQL naming) is set explicitly: the SQL0443 error seen earlier with STARTING_*
+        # parameters in the UDF call only occurs when NAMING=1 is used.
         self.host = host
-        self.conn_str = f"DRIVER={{{driver}}};SYSTEM={host};UID={user};PWD={password};"
+        self.conn_str = f"DRIVER={{{driver}}};SYSTEM={host};UID={user};PWD={password};NAMING=0;"
         self.logger = logger
+        self.syslog_handler = syslog_handler
+        self.bookmarks = bookmarks
         self.interval = interval
+        # 無新條目時輪詢間隔的上限；未設定時維持固定間隔
+        self.max_interval = max(max_interval or interval, interval)
+        self.consecutive_empty = 0
+        self.fetch_size = fetch_size
+        # 查詢逾時秒數，0 表示不限制 (第一次完整同步可能需要較長時間)
+        self.query_timeout = query_timeout
         self.journal_lib = journal_lib
         self.journal_name = journal_name
         # 將逗號分隔的字串轉換為列表，並過濾掉空字串
         self.journal_types = [t.strip() for t in journal_types.split(',') if t.strip()]
+        # 以 client 端過濾 journal_entry_type 時，SQL 不含 IN 條件，改在迴圈中比對此集合
+        self._allowed_types: Optional[frozenset[str]] = None
+        if client_type_filter and self.journal_types:
+            self._allowed_types = frozenset(self.journal_types)
+        # The query text, its journal-type parameters and the per-row write call do not change
+        # after construction.
+        self._sql = self._build_sql()
+        self._type_params = tuple(self.journal_types) if self._allowed_types is None else ()
+        self._write_messages = syslog_handler.write_messages
+        # Delivery of this monitor's entries, tracked apart from the other monitors sharing the handler.
+        self._delivery = DeliveryStats()
         
-        # State is now managed in memory and reset on each program start.
-        # This ensures the first query of every run is a full sync.
+        # The bookmark is persisted in the BookmarkStore, so a restart resumes where the last run stopped.
+        # Without a saved bookmark the first query is a full sync.
+        self.last_receiver_library: Optional[str] = None
         self.last_receiver_name: Optional[str] = None
         self.last_sequence_number: Optional[int] = None
+        self._saved_bookmark = bookmarks.load(host, journal_lib, journal_name)
+        if self._saved_bookmark:
+            self.last_receiver_library, self.last_receiver_name, self.last_sequence_number = self._saved_bookmark
+
+        # Starting receiver used when there is no bookmark. Switched to '*CURCHAIN' when the
+        # bookmarked receiver has been deleted, so the remaining receivers are not skipped.
+        self._start_receiver = '*CURRENT'
+
+        # One long-lived connection per monitor, opened lazily and re-opened only after a failure.
+        self.conn: Optional[pyodbc.Connection] = None
+        # The cursor is reused across cycles: pyodbc only re-prepares when the SQL text changes.
+        self._cursor: Optional[pyodbc.Cursor] = None
+
+    def _build_sql(self) -> str:
+        """建立查詢 SQL；文字在每個週期都相同，因此於初始化時只建立一次。"""
+        # The bookmark is passed to DISPLAY_JOURNAL through its STARTING_* parameters, so the
+        # journal reader starts at the last processed entry instead of the whole journal being
+        # read and filtered afterwards in the WHERE clause.
+        # Without ENDING_RECEIVER_* the range ends at the starting receiver, so a bookmark on a
+        # receiver that has since been detached would never reach the entries written after it.
+        journal_call_str = ", ".join([
+            "?, ?",
+            "STARTING_RECEIVER_LIBRARY => ?",
+            "STARTING_RECEIVER_NAME => ?",
+            "STARTING_SEQUENCE => ?",
+            "ENDING_RECEIVER_LIBRARY => '*LIBL'",
+            "ENDING_RECEIVER_NAME => '*CURRENT'",
+            "GENERATE_SYSLOG => 'RFC5424'",
+        ])
+
+        sql = f"""
+            SELECT syslog_event, journal_entry_type, receiver_name, sequence_number, receiver_library
+            FROM TABLE (QSYS2.DISPLAY_JOURNAL({journal_call_str})) AS X
+        """
+
+        where_clauses = ["syslog_event IS NOT NULL"]
+        # STARTING_SEQUENCE is inclusive; skip the bookmarked entry, which was already sent.
+        where_clauses.append("NOT (receiver_name = ? AND sequence_number = ?)")
+
+        if self.journal_types and self._allowed_types is None:
+            placeholders = ', '.join('?' for _ in self.journal_types)
+            where_clauses.append(f"journal_entry_type IN ({placeholders})")
+
+        sql += " WHERE " + " AND ".join(where_clauses)
+        sql += " ORDER BY receiver_name, sequence_number"
+        return sql
+
+    def _get_connection(self) -> pyodbc.Connection:
+        """取得持續使用的資料庫連線，尚未建立或先前失敗時才重新連線。"""
+        if self.conn is None:
+            # autocommit=True so the long-lived connection does not keep a transaction open between cycles.
+            conn = pyodbc.connect(self.conn_str, autocommit=True, timeout=self.LOGIN_TIMEOUT)
+            # Parameters are sent as UTF-8 SQL_CHAR instead of pyodbc's default UTF-16 wide binding.
+            # Decoding is left at pyodbc's defaults: SQL_CHAR is already read as UTF-8, and SQL_WCHAR
+            # keeps the driver's native UTF-16LE (decoding it as UTF-8 would garble every wide column).
+            conn.setencoding(encoding='utf-8')
+            conn.timeout = self.query_timeout
+            self.conn = conn
+            self.logger.debug("[%s] Connected to IBM i database.", self.host)
+        return self.conn
 
-    def _process_one_batch(self):
-        """連接、獲取一批新的日誌條目、處理它們並更新狀態。"""
-        # 1. Attempt to connect to the database
+    def _get_cursor(self) -> pyodbc.Cursor:
+        """取得重複使用的 cursor，必要時先建立連線。"""
+        if self._cursor is None:
+            self._cursor = self._get_connection().cursor()
+            self._cursor.arraysize = self.fetch_size
+        return self._cursor
+
+    def _close_connection(self):
+        """關閉資料庫連線，下次查詢時會重新連線。"""
+        if self.conn is None:
+            return
         try:
-            # Reverting to autocommit=False to match the behavior of the successful testing.py script.
-            conn = pyodbc.connect(self.conn_str)
+            if self._cursor is not None:
+                self._cursor.close()
+            self.conn.close()
+        except pyodbc.Error:
+            pass  # The connection is already broken; nothing else to clean up.
+        self._cursor = None
+        self.conn = None
+
+    def _save_state(self):
+        """保存目前的書籤；與上次保存的內容相同時略過寫入。"""
+        bookmark = (self.last_receiver_library, self.last_receiver_name, self.last_sequence_number)
+        if bookmark == self._saved_bookmark:
+            return
+        self.bookmarks.save(self.host, self.journal_lib, self.journal_name, *bookmark)
+        self._saved_bookmark = bookmark
+
+    def _process_one_batch(self) -> int:
+        """連接、獲取一批新的日誌條目、處理它們並更新狀態，回傳轉送到 syslog 的筆數。"""
+        # 1. Get the (possibly cached) database connection and cursor
+        try:
+            cursor = self._get_cursor()
         except pyodbc.Error:
             # Use logger.exception to automatically log stack traces for better debugging
             self.logger.exception("Database connection failed. Check credentials, host, and driver.")
             # If connection fails, we cannot proceed. Return and wait for the next cycle.
-            return
+            return 0
 
         # 2. If connection is successful, prepare and execute the query
         try:
-            # --- Final and Most Robust Solution: Filter in the WHERE clause ---
-            # All attempts to use STARTING_* parameters in the UDF call have proven unstable.
-            # The most reliable method is to fetch all entries from the UDF and apply filtering
-            # in a standard SQL WHERE clause, which is stable and well-supported.
-            journal_call_str = f"'{self.journal_lib}', '{self.journal_name}', GENERATE_SYSLOG => 'RFC5424'"
-
-            sql = f"""
-                SELECT syslog_facility, syslog_severity, syslog_event, journal_entry_type,
-                       receiver_name, sequence_number
-                FROM TABLE (QSYS2.DISPLAY_JOURNAL({journal_call_str})) AS X
-            """
-            
-            params: list[Any] = []
-            where_clauses = ["syslog_event IS NOT NULL"]
-            
-            # Add filtering for the starting point directly in the WHERE clause
-            if self.last_receiver_name and self.last_sequence_number:
-                where_clauses.append("(receiver_name > ? OR (receiver_name = ? AND sequence_number > ?))")
-                params.extend([self.last_receiver_name, self.last_receiver_name, self.last_sequence_number])
-
-            if self.journal_types:
-                placeholders = ', '.join('?' for _ in self.journal_types)
-                where_clauses.append(f"journal_entry_type IN ({placeholders})")
-                params.extend(self.journal_types)
-
-            if where_clauses:
-                sql += " WHERE " + " AND ".join(where_clauses)
-
-            sql += " ORDER BY receiver_name, sequence_number"
-
-            with conn.cursor() as cursor:
-                print(f"[{self.host}] Checking for new journal entries...")
-                # 顯示將要執行的 SQL 語句和參數，以利除錯
-                print(f"[{self.host}] Executing SQL: {sql}")
-                print(f"[{self.host}] With parameters: {params}")
-                cursor.execute(sql, params)
-                
-                count = 0
-                last_row = None
-                # Iterate directly on the cursor to save memory, especially for large batches.
-                for row in cursor:
-                    if count == 0:
-                        print(f"[{self.host}] Found new entries. Processing and sending to syslog...")
-                    
-                    syslog_event = row.SYSLOG_EVENT
-                    syslog_severity = row.SYSLOG_SEVERITY
-                    log_level = self.SEVERITY_MAP.get(syslog_severity, logging.INFO)
-                    self.logger.log(log_level, syslog_event)
-                    
-                    last_row = row # Keep track of the last processed row
-                    count += 1
+            # See _build_sql() for why the bookmark goes into the UDF's STARTING_* parameters.
+            # Without a bookmark the UDF's defaults are passed explicitly and the skip predicate
+            # gets values that never match an entry, so the SQL text never changes.
+            params: list[Any] = [self.journal_lib, self.journal_name]
+            if self.last_receiver_name is not None and self.last_sequence_number is not None:
+                params.extend([self.last_receiver_library, self.last_receiver_name, self.last_sequence_number])
+                params.extend([self.last_receiver_name, self.last_sequence_number])
+            else:
+                params.extend(['*LIBL', self._start_receiver, None])
+                params.extend(['', 0])
+            params.extend(self._type_params)
+            sql = self._sql
 
+            # Diagnostics go through logger.debug with lazy %-style arguments (or an isEnabledFor
+            # guard), so nothing is formatted unless LOG_LEVEL is DEBUG.
+            self.logger.debug("[%s] Checking for new journal entries...", self.host)
+            # 顯示將要執行的 SQL 語句和參數，以利除錯
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug(f"[{self.host}] Executing SQL: {sql}")
+                self.logger.debug(f"[{self.host}] With parameters: {params}")
+            cursor.execute(sql, params)
+            
+            count = 0
+            # Entries actually sent; differs from count when the client-side type filter skips rows.
+            forwarded = 0
+            handler = self.syslog_handler
+            delivery = self._delivery
+            dropped_mark = delivery.dropped_total
+            last_row = None
+            # Column ordinals of the SELECT list in _build_sql(); tuple indexing avoids pyodbc's per-access name lookup.
+            EVENT, TYPE, RCV, SEQ, RCV_LIB = 0, 1, 2, 3, 4
+            # Bind hot-loop lookups to locals once per batch.
+            write = self._write_messages
+            allowed = self._allowed_types
+            # Fetch in chunks: one fetchmany() call per fetch_size rows instead of one per row.
+            # A batch smaller than fetch_size comes back in a single C-level call, like fetchall(),
+            # while memory stays bounded for large batches.
+            while rows := cursor.fetchmany(cursor.arraysize):
                 if count == 0:
-                    print(f"[{self.host}] No new journal entries found in this cycle.")
-                    return
-                
-                if last_row:
-                    self.last_receiver_name = last_row.RECEIVER_NAME
-                    self.last_sequence_number = int(last_row.SEQUENCE_NUMBER)
-                    print(f"[{self.host}] Finished sending {count} entries. New bookmark: {self.last_receiver_name}/{self.last_sequence_number}")
-                    self.logger.info(f"[{self.host}] Processed {count} entries. New state: {self.last_receiver_name}/{self.last_sequence_number}")
+                    self.logger.debug("[%s] Found new entries. Processing and sending to syslog...", self.host)
+
+                # SYSLOG_EVENT is already a complete RFC5424 message, so it is written to the
+                # syslog socket as-is instead of going through the logging machinery.
+                # Every entry is forwarded whatever its syslog severity; the logger's level only
+                # controls this program's own diagnostics.
+                if allowed is None:
+                    events = [row[EVENT] for row in rows]
+                else:
+                    events = [row[EVENT] for row in rows if row[TYPE] in allowed]
+                write(events, delivery)
+                forwarded += len(events)
+
+                # Filtered rows still move the bookmark, so they are not read again.
+                last_row = rows[-1] # Keep track of the last processed row
+                count += len(rows)
+                # Once a batch is dropped the bookmark stays put anyway; stop instead of waiting
+                # ENQUEUE_TIMEOUT for every remaining chunk.
+                if delivery.dropped_total != dropped_mark:
+                    break
+
+            # Hand whatever is still buffered to the syslog writer before the bookmark moves forward.
+            handler.flush()
+
+            if count == 0:
+                self.logger.debug("[%s] No new journal entries found in this cycle.", self.host)
+                return 0
+
+            # Only move the bookmark once the writer has sent everything without dropping a batch;
+            # otherwise the same entries are read again next cycle (and may be sent twice).
+            if not handler.wait_sent(delivery) or delivery.dropped_total != dropped_mark:
+                self.logger.warning(
+                    f"[{self.host}] Some journal entries could not be sent to the syslog server. "
+                    f"Keeping bookmark {self.last_receiver_name}/{self.last_sequence_number}; they will be read again."
+                )
+                # Treated like an empty cycle, so a failing server is retried with backoff.
+                return 0
+
+            if last_row:
+                self.last_receiver_library = last_row[RCV_LIB]
+                self.last_receiver_name = last_row[RCV]
+                self.last_sequence_number = int(last_row[SEQ])
+                self._save_state()
+                self.logger.info(f"[{self.host}] Processed {forwarded} entries. New state: {self.last_receiver_name}/{self.last_sequence_number}")
+            return forwarded
 
         except pyodbc.Error:
+            # A bookmarked receiver that was detached and deleted makes every STARTING_RECEIVER_NAME
+            # query fail; restart from the receiver chain instead of failing forever.
+            if self.last_receiver_name is not None and not self._bookmark_receiver_exists():
+                self.logger.warning(
+                    f"[{self.host}] Bookmarked journal receiver {self.last_receiver_library}/{self.last_receiver_name} "
+                    "no longer exists. Restarting from the current receiver chain; some entries may be sent again."
+                )
+                self._reset_bookmark()
+                return 0
             self.logger.exception("Database query or processing failed. Check SQL syntax and permissions.")
-        finally:
-            # The connection will be closed here regardless of whether the query succeeded or failed.
-            if conn:
-                conn.close()
+            # The connection may be unusable now; drop it so the next cycle reconnects.
+            self._close_connection()
+            return 0
+
+    def _bookmark_receiver_exists(self) -> bool:
+        """確認書籤所指的 journal receiver 是否仍存在；無法確認時視為存在。"""
+        try:
+            # A separate cursor, so the cached one keeps its prepared journal query.
+            with self._get_connection().cursor() as cursor:
+                cursor.execute(
+                    "SELECT COUNT(*) FROM TABLE (QSYS2.OBJECT_STATISTICS(?, '*JRNRCV', ?)) AS X",
+                    [self.last_receiver_library, self.last_receiver_name],
+                )
+                return cursor.fetchone()[0] > 0
+        except pyodbc.Error:
+            return True
 
-    def start(self, shutdown_event: threading.Event):
+    def _reset_bookmark(self):
+        """捨棄已失效的書籤，下一個週期從目前的 receiver chain 開頭重新讀取。"""
+        self.last_receiver_library = None
+        self.last_receiver_name = None
+        self.last_sequence_number = None
+        self._start_receiver = '*CURCHAIN'
+
+    async def start(self, shutdown_event: asyncio.Event, initial_delay: float = 0):
         """啟動持續監控的迴圈。"""
-        self.logger.info(f"[{self.host}] Monitor thread started.")
+        self.logger.info(f"[{self.host}] Monitor started.")
+        if initial_delay:
+            try:
+                await asyncio.wait_for(shutdown_event.wait(), timeout=initial_delay)
+            except asyncio.TimeoutError:
+                pass
         while not shutdown_event.is_set():
-            self._process_one_batch()
-            print(f"[{self.host}] Waiting for {self.interval} seconds before next check...")
-            # Use event.wait for a stoppable sleep
-            shutdown_event.wait(self.interval)
+            # pyodbc calls block, so the batch runs in a worker thread while the event loop
+            # keeps serving the other monitors.
+            try:
+                count = await asyncio.to_thread(self._process_one_batch)
+                # Push out operational messages logged during the batch as well.
+                await asyncio.to_thread(self.syslog_handler.flush)
+            except Exception:
+                # Anything _process_one_batch does not handle itself (e.g. sqlite3.Error from the
+                # bookmark store) must not end this task; gather() would then stop every host.
+                self.logger.exception(f"[{self.host}] Unexpected error while processing journal entries. Retrying next cycle.")
+                count = 0
+            dropped = self.syslog_handler.take_dropped(self._delivery)
+            if dropped:
+                self.logger.warning(f"[{self.host}] {dropped} syslog messages were dropped because the syslog server was too slow or unreachable.")
+            # Back off exponentially (up to max_interval) while the journal stays quiet,
+            # and return to the base interval as soon as new entries show up.
+            if count:
+                self.consecutive_empty = 0
+                sleep_for = self.interval
+            else:
+                sleep_for = min(self.interval * 2 ** (self.consecutive_empty + 1), self.max_interval)
+                # Only count further until the cap is reached, so the exponent stays small.
+                if sleep_for < self.max_interval:
+                    self.consecutive_empty += 1
+            self.logger.debug("[%s] Waiting for %s seconds before next check...", self.host, sleep_for)
+            # Stoppable sleep: returns early as soon as shutdown_event is set
+            try:
+                await asyncio.wait_for(shutdown_event.wait(), timeout=sleep_for)
+            except asyncio.TimeoutError:
+                pass
+        self._close_connection()
 
-def create_monitors_from_env(logger: logging.Logger, interval: int) -> list[IbmiJournalMonitor]:
+def create_monitors_from_env(logger: logging.Logger, syslog_handler: BufferedSysLogHandler, bookmarks: BookmarkStore, interval: int, max_interval: int, fetch_size: int, client_type_filter: bool, query_timeout: int) -> list[IbmiJournalMonitor]:
     """從環境變數讀取設定並建立 IbmiJournalMonitor 實例列表。"""
     monitors = []
     index = 1
@@ -165,52 +663,82 @@ def create_monitors_from_env(logger: logging.Logger, interval: int) -> list[Ibmi
         journal_types = os.getenv(f'IBMI_JOURNAL_TYPES_{index}', '')
 
         logger.info(f"Found configuration for host: {host}")
-        monitor = IbmiJournalMonitor(host, user, password, driver, logger,
-                                     journal_lib, journal_name, journal_types, interval)
+        monitor = IbmiJournalMonitor(host, user, password, driver, logger, syslog_handler, bookmarks,
+                                     journal_lib, journal_name, journal_types, interval, max_interval, fetch_size,
+                                     client_type_filter, query_timeout)
         monitors.append(monitor)
         index += 1
     return monitors
 
+async def run_monitors(monitors: list[IbmiJournalMonitor], logger: logging.Logger):
+    """在單一事件迴圈中同時執行所有監控器，直到收到關閉信號。"""
+    shutdown_event = asyncio.Event()
+
+    def request_shutdown():
+        logger.info("Shutdown signal received. Stopping all monitors...")
+        shutdown_event.set()
+
+    loop = asyncio.get_running_loop()
+    # Batches run on a bounded pool rather than one thread per host; asyncio.run() shuts it
+    # down and waits for running batches on exit.
+    max_workers = min(32, len(monitors))
+    loop.set_default_executor(
+        concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='journal-monitor')
+    )
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, request_shutdown)
+        except NotImplementedError:
+            # Not available on Windows; Ctrl+C then surfaces as KeyboardInterrupt in main().
+            pass
+
+    # Spread the first polls over one interval so the hosts do not all query and send at once.
+    tasks = [
+        asyncio.create_task(monitor.start(shutdown_event, initial_delay=monitor.interval * i / len(monitors)))
+        for i, monitor in enumerate(monitors)
+    ]
+    await asyncio.gather(*tasks)
+
 def main():
     """程式主進入點。"""
     load_dotenv()
 
     # --- 全域設定 ---
     syslog_server = os.getenv('SYSLOG_SERVER_IP', '127.0.0.1')
-    logger = setup_syslog_logging(server=syslog_server)
-    logger.info(f'Syslog handler configured for server: {syslog_server}')
+    syslog_protocol = os.getenv('SYSLOG_PROTOCOL', 'udp')
+    # Only enable for receivers that split one UDP datagram into several newline-separated messages.
+    coalesce_udp = os.getenv('SYSLOG_UDP_COALESCE', 'false').lower() in ('1', 'true', 'yes')
+    # 主控台的記錄等級 (DEBUG、INFO、WARNING...)；轉送到 syslog 的至少為 INFO
+    log_level = os.getenv('LOG_LEVEL', 'INFO').upper()
+    logger, syslog_handler = setup_syslog_logging(server=syslog_server, protocol=syslog_protocol,
+                                                  coalesce_udp=coalesce_udp, level=log_level)
+    logger.info(f'Syslog handler configured for server: {syslog_server} ({syslog_protocol})')
     interval = int(os.getenv('POLLING_INTERVAL_SECONDS', 60))
+    max_interval = int(os.getenv('POLLING_INTERVAL_MAX_SECONDS', interval))
+    fetch_size = int(os.getenv('ODBC_FETCH_SIZE', IbmiJournalMonitor.FETCH_SIZE))
+    # 'sql' (預設) 於查詢中以 IN 條件過濾 journal_entry_type；'client' 改為取回後在程式中過濾
+    client_type_filter = os.getenv('JOURNAL_TYPES_FILTER', 'sql').lower() == 'client'
+    query_timeout = int(os.getenv('ODBC_QUERY_TIMEOUT_SECONDS', 0))
+    bookmarks = BookmarkStore(os.getenv('STATE_DB_PATH', 'monitors.db'))
 
     # --- 建立監控器 ---
-    monitors = create_monitors_from_env(logger, interval)
+    monitors = create_monitors_from_env(logger, syslog_handler, bookmarks, interval, max_interval, fetch_size,
+                                        client_type_filter, query_timeout)
     if not monitors:
-        print("No host configurations found. Please check your .env file.", file=sys.stderr)
-        logger.error("No host configurations found. Exiting.")
+        logger.error("No host configurations found. Please check your .env file. Exiting.")
         sys.exit(1)
 
-    # --- 啟動執行緒 ---
-    threads = []
-    shutdown_event = threading.Event()
-    print(f"Starting {len(monitors)} monitor(s). Press Ctrl+C to stop.")
-    logger.info(f"Starting {len(monitors)} monitor(s).")
-
-    for monitor in monitors:
-        thread = threading.Thread(target=monitor.start, args=(shutdown_event,))
-        thread.start()
-        threads.append(thread)
+    # --- 啟動監控器 ---
+    logger.info(f"Starting {len(monitors)} monitor(s). Press Ctrl+C to stop.")
 
     # --- 等待中斷信號以優雅地關閉 ---
     try:
-        # 主執行緒等待，直到所有監控執行緒結束
-        for thread in threads:
-            thread.join()
+        asyncio.run(run_monitors(monitors, logger))
     except KeyboardInterrupt:
-        print("\nShutdown signal received. Stopping all monitors...")
+        # asyncio.run() has already cancelled the monitors and waited for running batches to finish.
         logger.info("Shutdown signal received. Stopping all monitors...")
-        shutdown_event.set()
-        # 再次 join 以確保所有執行緒都已乾淨地退出
-        for thread in threads:
-            thread.join()
+    finally:
+        bookmarks.close()
 
     print("All monitors have been shut down. Exiting.")
     logger.info("Daemon stopped.")